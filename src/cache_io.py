@@ -0,0 +1,63 @@
+"""
+cache_io.py - Reading and writing the compressed page cache.
+
+Author: Gabriel Peery
+Date: 10/14/2026
+"""
+import bz2
+from errors import *
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Magic bytes of each format a cache may be stored in
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_GZIP_MAGIC = b"\x1f\x8b"
+_BZIP2_MAGIC = b"BZ"
+
+# Compression level used when writing with zstandard
+ZSTD_LEVEL = 10
+
+# Errors that reading a damaged cache may raise: OSError from gzip and
+# bz2, ValueError, EOFError for a cut off cache, and zstandard's own
+READ_ERRORS = (OSError, ValueError, EOFError) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+
+def open_write(path : str):
+    """
+    Opens the cache at path for writing bytes. Compresses with zstandard
+    if it is installed, otherwise with gzip.
+    """
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            open(path, "wb")
+        )
+    return gzip.open(path, "wb")
+
+
+def open_read(path : str):
+    """
+    Opens the cache at path for reading bytes, detecting whether it was
+    compressed with zstandard, gzip, or bzip2 (as older caches were).
+    Raises ValueError if it is none of those.
+    """
+    with open(path, "rb") as file_obj:
+        magic = file_obj.read(len(_ZSTD_MAGIC))
+
+    if magic == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise DependencyNotFoundError(
+                f"{path} needs the 'zstandard' module to be read."
+            )
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(path, "rb")
+    if magic.startswith(_BZIP2_MAGIC):
+        return bz2.open(path, "rb")
+    raise ValueError(f"{path} doesn't look like a cache file.")
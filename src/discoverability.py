@@ -7,44 +7,152 @@ Author: Gabriel Peery
 Date: 3/12/2022
 """
 import argparse
-import bz2
+import cache_io
 import json
 import numpy as np
 import os
-import pickle
-from scipy.sparse import save_npz, load_npz
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.pipeline import make_pipeline
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-def search_cosine(tfidf, query, count, vectorizer, corpus):
+
+# Arrays of the term matrix, each saved to its own file
+_MATRIX_ARRAYS = ("data", "indices", "indptr")
+
+# Number of columns terms are hashed into
+_FEATURE_COUNT = 2 ** 20
+
+
+def _model_paths(cache_dir):
+    """Returns the paths of the idf, term shape, and term array files."""
+    return (
+        os.path.join(cache_dir, ".idf.npy"),
+        os.path.join(cache_dir, ".term_shape.npy"),
+        [
+            os.path.join(cache_dir, f".term_{name}.npy")
+            for name in _MATRIX_ARRAYS
+        ]
+    )
+
+
+def make_vectorizer():
+    """
+    Returns the pipeline that turns text into float32 tfidf vectors, with
+    logarithmic term frequencies. Terms are hashed to columns, so the
+    only state to fit is the idf vector of the final TfidfTransformer.
+    """
+    return make_pipeline(
+        HashingVectorizer(
+            n_features=_FEATURE_COUNT,
+            alternate_sign=False,
+            norm=None,
+            decode_error="replace",
+            dtype=np.float32
+        ),
+        TfidfTransformer(norm="l2", sublinear_tf=True)
+    )
+
+
+def term_matrix(tfidf):
+    """
+    Given the tfidf matrix with a row per document, returns it as a CSR
+    matrix with a row per term, so the documents containing a term and
+    their weights sit next to each other.
+    """
+    return tfidf.T.tocsr()
+
+
+def save_model(vectorizer, terms, cache_dir):
+    """
+    Saves the idf vector of the fitted vectorizer and the term matrix in
+    cache_dir as plain arrays, so load_model can map them back in
+    without unpickling or copying.
+    """
+    idf_path, shape_path, array_paths = _model_paths(cache_dir)
+    np.save(idf_path, vectorizer[-1].idf_)
+    np.save(shape_path, np.array(terms.shape))
+    for name, array_path in zip(_MATRIX_ARRAYS, array_paths):
+        np.save(array_path, getattr(terms, name))
+
+
+def load_model(cache_dir):
+    """
+    Loads the vectorizer and term matrix written by save_model. The
+    matrix arrays are memory mapped rather than read.
+    """
+    idf_path, shape_path, array_paths = _model_paths(cache_dir)
+    vectorizer = make_vectorizer()
+    vectorizer[-1].idf_ = np.load(idf_path, mmap_mode="r")
+    terms = csr_matrix(
+        tuple(np.load(array_path, mmap_mode="r") for array_path in array_paths),
+        shape=tuple(np.load(shape_path))
+    )
+    return vectorizer, terms
+
+
+def model_exists(cache_dir):
+    """Returns True if save_model has written every file to cache_dir."""
+    idf_path, shape_path, array_paths = _model_paths(cache_dir)
+    return all(
+        os.path.exists(path) for path in [idf_path, shape_path] + array_paths
+    )
+
+
+def iter_documents(cache_file):
+    """
+    Yields the name and joined section text of each page in the open
+    cache_file. With ijson installed, pages are parsed one at a time
+    rather than loading the whole cache at once.
+    """
+    if ijson is not None:
+        pages = ijson.kvitems(cache_file, "")
+    else:
+        pages = json.load(cache_file).items()
+    for name, elements in pages:
+        yield name, " ".join(text for text in elements["sections"].values())
+
+
+def search_cosine(terms, query, count, vectorizer, names):
+    # Documents and query are both L2 normalized, so their dot product is
+    # already the cosine similarity
     input_vector = vectorizer.transform([query])
-    scores = (tfidf @ input_vector.T).toarray().T[0]
-    top_indices = np.argsort(scores)[-1:-count:-1]
-    return list(map(lambda x : x[0], (corpus[idx] for idx in top_indices)))
+    # Only the rows of terms in the query can add to a score
+    scores = np.zeros(terms.shape[1], dtype=terms.dtype)
+    for term, weight in zip(input_vector.indices, input_vector.data):
+        start, end = terms.indptr[term], terms.indptr[term + 1]
+        scores[terms.indices[start:end]] += weight * terms.data[start:end]
+    # Only the best count scores need to be sorted
+    count = min(count, len(scores))
+    best = np.argpartition(scores, -count)[-count:]
+    top_indices = best[np.argsort(-scores[best])]
+    return [str(names[idx]) for idx in top_indices]
 
 
 def post_process_search(query, results):
-    match_count = 0
-    for result_idx in range(len(results)):
-        real_result = results[result_idx]
-        result = real_result.split()[0]
-        if query in result:
-            if query == result:
-                # Case it is identical
-                results.pop(result_idx)
-                results.insert(0, real_result)
-            else:
-                # Case it is merely part of name
-                results.pop(result_idx)
-                results.insert(match_count, real_result)
-            match_count += 1
-    return results
-
-
-def full_search(tfidf, query, count, vectorizer, corpus):
+    # Pages named exactly the query go first, then pages with the query
+    # in their name, then the rest, each kept in score order
+    exact, partial, rest = [ ], [ ], [ ]
+    for result in results:
+        name = result.split(None, 1)[0]
+        if query == name:
+            exact.append(result)
+        elif query in name:
+            partial.append(result)
+        else:
+            rest.append(result)
+    return exact + partial + rest
+
+
+def full_search(terms, query, count, vectorizer, names):
     return post_process_search(
         query,
-        search_cosine(tfidf, query, count, vectorizer, corpus)
+        search_cosine(terms, query, count, vectorizer, names)
     )
 
 
@@ -55,58 +163,46 @@ def main():
     parser.add_argument("terms", type=str, nargs="+", help="terms to search")
     args = parser.parse_args()
 
-    # Retrieve model (tfidf)
+    # Retrieve model (tfidf, by term)
     cache_dir = os.path.join(
         os.path.dirname(os.path.realpath(os.path.abspath(__file__))),
         os.path.pardir,
         "cache"
     )
-    matrix_path = os.path.join(cache_dir, ".matrix")
-    corpus_path = os.path.join(cache_dir, ".corpus")
-    vectorizer_path = os.path.join(cache_dir, ".vectorizer")
+    # Only the names of the corpus are kept, texts are in the model
+    names_path = os.path.join(cache_dir, ".names.npy")
     cache_path = os.path.join(cache_dir, "discoverability_cache")
-    if not (
-        os.path.exists(matrix_path)
-        and os.path.exists(corpus_path)
-        and os.path.exists(vectorizer_path)
-    ):
+    if not (os.path.exists(names_path) and model_exists(cache_dir)):
         # Need to create
         if os.path.exists(cache_path):
             # All good to create - cache exists
-            with bz2.open(cache_path) as cache_file:
-                corpus_dict = json.load(cache_file)
+            with cache_io.open_read(cache_path) as cache_file:
                 # Just a quick tfidf model creation; format first
-                corpus_dict = {
-                    name : " ".join(
-                        text for text in elements["sections"].values()
-                    ) for name, elements in corpus_dict.items()
-                }
-                corpus = [(name, text) for name, text in corpus_dict.items()]
-                vectorizer = TfidfVectorizer(decode_error="replace")
-                tfidf = vectorizer.fit_transform(map(lambda x : x[1], corpus))
+                names = [ ]
+                def texts():
+                    for name, text in iter_documents(cache_file):
+                        names.append(name)
+                        yield text
+                vectorizer = make_vectorizer()
+                tfidf = vectorizer.fit_transform(texts())
+                terms = term_matrix(tfidf)
                 # Save
-                with open(matrix_path, "wb") as matrix_file:
-                    save_npz(matrix_file, tfidf)
-                with open(corpus_path, "wb") as corpus_file:
-                    pickle.dump(corpus, corpus_file)
-                with open(vectorizer_path, "wb") as vectorizer_file:
-                    pickle.dump(vectorizer, vectorizer_file)
+                save_model(vectorizer, terms, cache_dir)
+                names = np.array(names)
+                np.save(names_path, names)
                 # Free some memory
-                del corpus_dict
+                del tfidf
         else:
             raise FileNotFoundError(f"Could not find cache at {cache_path}")
     else:
         # Grab it from before
-        with open(matrix_path, "rb") as matrix_file:
-            tfidf = load_npz(matrix_file)
-        with open(corpus_path, "rb") as corpus_file:
-            corpus = pickle.load(corpus_file)
-        with open(vectorizer_path, "rb") as vectorizer_file:
-            vectorizer = pickle.load(vectorizer_file)
+        vectorizer, terms = load_model(cache_dir)
+        # Only the names of the results are ever read
+        names = np.load(names_path, mmap_mode="r")
 
     # Retrieve information
     query = ' '.join(args.terms)
-    for result in full_search(tfidf, query, 20, vectorizer, corpus):
+    for result in full_search(terms, query, 20, vectorizer, names):
         print(result)
 
 
@@ -5,13 +5,24 @@ Author: Gabriel Peery
 Date: 1/25/2022
 """
 import argparse
-import bz2
+import cache_io
 from errors import *
 import json
+import model
+import multiprocessing
 import os
 import page_interface as pi
 import subprocess
-from typing import List
+from typing import Dict, Iterator, List, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Number of pages handed to a worker at a time
+_CHUNK_SIZE = 16
 
 
 def get_manpaths(debug = False):
@@ -46,10 +57,124 @@ def get_manpaths(debug = False):
         raise DependencyNotFoundError("Could not find 'manpath' to run.")
 
 
-def index(paths : List[str], verbose : bool, cache_file : str):
+def _iter_files(root : str) -> Iterator[os.DirEntry]:
+    """
+    Yields an entry for each file in the tree under root, following
+    links. Directories that can't be read are skipped.
+    """
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield from _iter_files(entry.path)
+                elif entry.is_file():
+                    yield entry
+    except OSError:
+        # Same as os.walk, ignore what can't be listed
+        return
+
+
+def _dumps(obj) -> bytes:
+    """Returns obj encoded as JSON, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("ascii")
+
+
+def _valid_utf8(text : str) -> str:
+    """
+    Returns text as valid UTF-8, with the surrogate escapes Python gives
+    the undecodable bytes of a file name replaced, so that any JSON
+    reader can take it back.
+    """
+    return os.fsencode(text).decode("utf-8", "replace")
+
+
+def _init_worker(section_file : Union[str, None], page_model : model.Model):
+    """
+    Gives a worker process the same section file and model as the
+    process indexing, whichever way the worker was started.
+    """
+    pi.set_section_file(section_file)
+    pi.set_model(page_model)
+
+
+def _load_cache(cache_file : str) -> dict:
+    """
+    Returns the pages saved in cache_file by a previous index, or an
+    empty dictionary if there is no readable cache there.
+    """
+    try:
+        with cache_io.open_read(cache_file) as cache:
+            return json.load(cache)
+    except cache_io.READ_ERRORS + (DependencyNotFoundError,):
+        # ValueError covers bad JSON as well as an unknown format, and a
+        # zstd cache can't be read without the zstandard module
+        return dict()
+
+
+def _read_page(source : Tuple[str, float]) -> pi.ManualPage:
+    """
+    Reads the page at a real path, given with its modification time, in
+    a worker process.
+    """
+    return pi.ManualPage(*source)
+
+
+def _is_unchanged(data : dict, modification_times : Dict[str, float]) -> bool:
+    """
+    Returns True if every file a cached page was read from was seen in
+    this walk, with the time given in modification_times (keyed by path),
+    and each still has the modification time it was read with. Any
+    other time, older included, means the file was replaced.
+    """
+    if "modification_times" not in data:
+        # Cached before times were kept per file
+        return False
+    return all(
+        path in modification_times and modification_times[path] == time
+        for path, time in zip(data["paths"], data["modification_times"])
+    )
+
+
+def prefetch(paths : List[str]):
+    """
+    Asks the kernel to start reading each of the files in paths into the
+    page cache, without waiting for any of the reads to finish. Does
+    nothing where posix_fadvise is not available.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # Will be reported when actually read
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def index(
+        paths : List[str],
+        verbose : bool,
+        cache_file : str,
+        jobs : Union[int, None] = None,
+        readahead : bool = False,
+        full : bool = False
+    ):
     """
     For each path in the list of strings, searches for manual pages.
-    If verbose, then prints useful debug information.
+    If verbose, then prints useful debug information. Pages are read by
+    jobs worker processes, or one per CPU if jobs is None. If
+    readahead, then every page is queued to be read from disk at once
+    before rendering starts, which helps on a cold cache.
+
+    Pages already in cache_file whose files haven't been modified since
+    are reused instead of read again, unless full is True. A full index
+    is needed after changing the sections to look for.
 
     Note that bad things will happen if there are link loops.
     """
@@ -60,69 +185,205 @@ def index(paths : List[str], verbose : bool, cache_file : str):
         except OSError:
             term_size = 80
 
+    # Default cache file
+    if cache_file is None:
+        cache_file = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            os.path.pardir,
+            "cache",
+            "discoverability_cache"
+        )
+
     print("Walking manpath...")
-    # Get Python objects
-    pages = dict() # Collection of ManualPage objects, keys are names
+    # Find every file to read, grouped by device and inode, which the
+    # entry's stat already holds, so each is only read once
+    files = dict() # Lists of entries seen, keys are (device, inode)
+    modification_times = dict() # Keys are paths seen and real paths
     for path in paths:
         # Walk each tree
-        for dirpath, _, files in os.walk(path, followlinks=True):
-            # Examine files
-            for file_iter in files:
-                # Extract path information
-                full_path = os.path.join(dirpath, file_iter)
-                real_path = os.path.realpath(full_path)
-                try:
-                    name = pi.ManualPage.get_name(real_path)
-                except ValueError:
-                    # Happens when wasn't a manual page, just ignore
-                    if verbose:
-                        print(("Skipped " + real_path).center(term_size, "%"))
-                    continue
+        for entry in _iter_files(path):
+            # Extract path information, the entry's stat is kept from
+            # the walk so the time costs no more lookups later
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Happens when removed during the walk
+                continue
+            files.setdefault((stat.st_dev, stat.st_ino), [ ]).append(entry)
+            modification_times[entry.path] = stat.st_mtime
+    print("...done.")
+
+    # Get Python objects
+    print("Reading pages...")
+    # Each name a file goes by is a page of its own, as hard links with
+    # different names are. Only links need resolving to find theirs,
+    # any other entry is its own real path
+    aliases = dict() # Other paths to each real path, keys are real paths
+    sources = [ ] # Tuples of name, real path and file key of each page
+    for key, entries in files.items():
+        real_paths = dict() # Real path for each name, keys are names
+        for entry in entries:
+            if entry.is_symlink():
+                real_path = os.path.realpath(entry.path)
+                modification_times.setdefault(
+                    real_path, modification_times[entry.path]
+                )
+            else:
+                real_path = entry.path
+
+            try:
+                name = pi.ManualPage.get_name(real_path)
+            except ValueError:
+                # Happens when wasn't a manual page, just ignore
+                if verbose:
+                    print(("Skipped " + real_path).center(term_size, "%"))
+                continue
+
+            if name not in real_paths:
+                real_paths[name] = real_path
+                aliases[real_path] = [ ]
+                sources.append((name, real_path, key))
+            if entry.path != real_paths[name]:
+                aliases[real_paths[name]].append(entry.path)
+    del files
+
+    # Reuse pages from the last index whose files haven't changed since
+    pages = dict() # Collection of ManualPage objects, keys are names
+    if not full:
+        old_cache = _load_cache(cache_file)
+        reused = set() # Names of pages taken from old_cache
+        # A cached page has no record of which output it was made of, so
+        # if any file of a name must be read, all of them are
+        stale = set() # Names with a file that must be read
+        for name, real_path, _ in sources:
+            data = old_cache.get(name)
+            if (
+                data is None
+                or real_path not in data["paths"]
+                or not _is_unchanged(data, modification_times)
+            ):
+                stale.add(name)
+
+        to_read = [ ]
+        for name, real_path, key in sources:
+            if name in stale:
+                to_read.append((name, real_path, key))
+                continue
+            data = old_cache[name]
+
+            if name not in pages:
+                pages[name] = pi.ManualPage.from_cache(
+                    data, real_path, modification_times[real_path]
+                )
+                reused.add(name)
+            else:
+                pages[name].record_alias(
+                    real_path, modification_times[real_path]
+                )
+            for full_path in aliases[real_path]:
+                pages[name].record_alias(
+                    full_path, modification_times[full_path]
+                )
+        if verbose:
+            print(f"Reused {len(reused)} pages from {cache_file}")
+        sources = to_read
+        del old_cache
+
+    if readahead:
+        prefetch([real_path for _, real_path, _ in sources])
+
+    # Only the first name of each file is read, the others are copied
+    # from it
+    first_reads = [ ] # Real paths to read
+    name_counts = dict() # Names to read for each file, keys are file keys
+    for _, real_path, key in sources:
+        if key not in name_counts:
+            first_reads.append(real_path)
+            name_counts[key] = 0
+        name_counts[key] += 1
+
+    # A warm run may have nothing left to read, don't start workers then
+    if first_reads:
+        with multiprocessing.Pool(
+            jobs,
+            initializer=_init_worker,
+            initargs=(pi.get_section_file(), pi.get_model())
+        ) as pool:
+            # Pages are read in the workers, results come back in walk order
+            read_pages = pool.imap(
+                _read_page,
+                (
+                    (real_path, modification_times[real_path])
+                    for real_path in first_reads
+                ),
+                chunksize=_CHUNK_SIZE
+            )
+            read_files = dict() # Pages as read, keys are file keys
+            for name, real_path, key in sources:
+                if key not in read_files:
+                    page = next(read_pages)
+                    if name_counts[key] > 1:
+                        # Keep it as read, the page may be merged into
+                        read_files[key] = page.copy_for(
+                            real_path, modification_times[real_path]
+                        )
+                    else:
+                        read_files[key] = None
+                else:
+                    # Another name of a file already read
+                    page = read_files[key].copy_for(
+                        real_path, modification_times[real_path]
+                    )
 
-                # Check if already seen
                 if name not in pages:
                     # First time analysis
                     if verbose:
                         print(real_path.center(term_size, "-"))
 
-                    page = pi.ManualPage(real_path)
                     pages[name] = page
 
                     if verbose:
                         print(page)
                 else:
                     # nth time analysis.
-                    pages[name].record_path(full_path)
+                    pages[name].merge(page)
+
+                # Other paths to the same file have nothing new to read
+                for full_path in aliases[real_path]:
+                    pages[name].record_alias(
+                        full_path, modification_times[full_path]
+                    )
     print("...done.")
 
     # Save python objects
     print("Writing to cache...")
-    # First, construct the dictionary
-    dict_to_dump = dict()
-    for name, page in pages.items():
-        try:
-            title, data = pi.ManualPage.get_save_info(page)
-            dict_to_dump[title] = data
-        except NoDataReadError:
-            # Happens when empty, just ignore
-            if verbose:
-                print(f"No data was read from {name}")
-            pass
-
-    # Convert to string
-    dump_str = json.dumps(dict_to_dump) + "\n"
-
-    # Default cache file
-    if cache_file is None:
-        cache_file = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)),
-            os.path.pardir,
-            "cache",
-            "discoverability_cache"
-        )
-
-    with bz2.open(cache_file, "wb") as cache:
-        cache.write(bytes(dump_str, 'ascii'))
+    # Write beside the old cache, then swap, so a failed write can't
+    # leave a broken cache behind
+    temp_file = cache_file + ".tmp"
+    with cache_io.open_write(temp_file) as cache:
+        # One JSON object keyed by title, written a page at a time so
+        # only one page's encoding is held at once
+        separator = b"{"
+        for name, page in pages.items():
+            try:
+                title, data = pi.ManualPage.get_save_info(page)
+            except NoDataReadError:
+                # Happens when empty, just ignore
+                if verbose:
+                    print(f"No data was read from {name}")
+                continue
+            # A name that isn't valid UTF-8 won't match its file after
+            # this, so such a page is read again on the next run
+            title = _valid_utf8(title)
+            data["title"] = _valid_utf8(data["title"])
+            data["paths"] = [_valid_utf8(path) for path in data["paths"]]
+            cache.write(separator + _dumps(title) + b":" + _dumps(data))
+            separator = b","
+        if separator == b"{":
+            # Nothing was written
+            cache.write(separator)
+        cache.write(b"}\n")
+    os.replace(temp_file, cache_file)
     print("...done.")
 
 
@@ -135,13 +396,26 @@ def main():
     parser.add_argument("-c", "--cache", metavar="CACHE", type=str,
             default=None, help="Destination cache file")
     parser.add_argument("-s", "--sections", metavar="SECTIONS", type=str,
-            default=None, help="Source sections to look for in pages")
+            default=None, help="Source sections to look for in pages "
+            "(implies -f)")
+    parser.add_argument("-j", "--jobs", metavar="JOBS", type=int,
+            default=None, help="Number of worker processes (default: one "
+            "per CPU)")
+    parser.add_argument("-r", "--readahead", action='store_const',
+            const=True, default=False, help="Queue all pages to be read "
+            "from disk before rendering")
+    parser.add_argument("-f", "--full", action='store_const', const=True,
+            default=False, help="Read every page again, ignoring the "
+            "existing cache")
     args = parser.parse_args()
     pi.set_section_file(args.sections)
 
+    # Cached pages hold the sections of whichever list they were read with
+    full = args.full or args.sections is not None
+
     # Retrieve information
     paths = get_manpaths()
-    index(paths, args.v, args.cache)
+    index(paths, args.v, args.cache, args.jobs, args.readahead, full)
 
 
 if __name__ == "__main__":
@@ -6,10 +6,24 @@ Date: 2/21/2022
 """
 
 
+class _Translation(dict):
+    """Translation table which maps any character it lacks to a space."""
+
+    def __missing__(self, key : int) -> str:
+        return " "
+
+
 class Model:
     """Contains info about search model and methods to interact."""
 
-    _GOOD_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    _GOOD_CHARS = frozenset(
+        "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    )
+
+    # Lowercases good characters, drops apostrophes, other characters
+    # become spaces
+    _TRANSLATION = _Translation({ord(c): c.lower() for c in _GOOD_CHARS})
+    _TRANSLATION[ord("'")] = None
 
     def __init__(self):
         """Constructor - TODO"""
@@ -19,11 +33,4 @@ class Model:
         """Prepare string for tokenization and other steps."""
         # Groff sometimes splits words like this
         text = text.replace("- ", "")
-        # Most characters should be replaced by space, but not all
-        replace_policy = lambda c : '' if c == "'" else ' '
-        return ' '.join((
-            ''.join([
-                c if c in self._GOOD_CHARS else replace_policy(c) for c in text
-            ])
-        ).split()).lower()
-
+        return " ".join(text.translate(self._TRANSLATION).split())
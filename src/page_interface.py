@@ -8,14 +8,47 @@ Date: 2/21/2022
 import bz2
 import enum
 from errors import *
+import functools
 import gzip
-from hashlib import sha1
+import hashlib
+import io
 import model
 import os
 import re
+import shutil
 import subprocess
+import types
 from typing import List, Tuple, Union
 
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# Matches a whole line of section title as output by groff: uppercase
+# words only, starting at the beginning of the line
+_SECTION_TITLE_RE = re.compile(rb"^[A-Z]+(?:[ \t]+[A-Z]+)*[ \t]*$", re.M)
+
+# Match groff's overstrike sequences for a bold or an italic character
+_BOLD_RE = re.compile(rb"(.)\x08\1")
+_ITALIC_RE = re.compile(rb"_\x08(.)")
+
+# Matches a line holding a roff request or comment, which a page already
+# rendered by groff (a cat page) won't have
+_ROFF_REQUEST_RE = re.compile(rb"^[.']", re.M)
+
+# Amount of a page's text looked at to tell whether it is rendered
+_HEAD_SIZE = 4096
+
+# Matches the whitespace around a line break, including any blank lines
+_LINE_BREAK_RE = re.compile(rb"\s*[\r\n]\s*")
+
 
 class _CompressT(enum.Enum):
     NONE = enum.auto()
@@ -28,21 +61,17 @@ class ManualPage:
     """Object containing information on a manual page."""
 
     # Magic bytes
-    _TYPE_LOOKUP = {
+    _TYPE_LOOKUP = types.MappingProxyType({
         b"\x1f\x8b" : _CompressT.GZIP,
         b"BZ" : _CompressT.BZIP2
-    }
-
-    # Maximum amount of chars to read in a block from decompressed text
-    # TODO - find fast value of this
-    BLOCK_SIZE = 1024
+    })
 
     @staticmethod
     def _name_valid(split_name : List[str]) -> bool:
         """
         Returns true if name looks like it could be to a manual page.
         """
-        return split_name[-2].isnumeric() and len(split_name) >= 3
+        return len(split_name) >= 3 and split_name[-2].isnumeric()
 
     @staticmethod
     def _get_name_and_section(path : str) -> Tuple[str, int]:
@@ -50,7 +79,7 @@ class ManualPage:
         Retrieves the name and section of the manual page at path.
         Raises ValueError if can't read it.
         """
-        split_name = path.split(os.path.sep)[-1].split(".")
+        split_name = os.path.basename(path).split(".")
 
         # Plaintext case:
         if split_name[-1].isnumeric():
@@ -73,15 +102,21 @@ class ManualPage:
         name, section = ManualPage._get_name_and_section(path)
         return name + f" ({section})"
 
-    def __init__(self, path : str):
+    def __init__(
+            self,
+            path : str,
+            modification_time : Union[float, None] = None
+        ):
         """
         A manual page object constructed from analyzing the file at the 
-        given path. Will decompress if needed.
+        given path. Will decompress if needed. If the file's modification
+        time is already known, it may be given to save looking it up.
 
         Note that the path should be the real path. If can't be read,
         will raise an error.
         """
         self._paths = [ ]
+        self._path_times = [ ] # Modification time of each path
         # Note: following may throw and error
         self._title, self._section_number = ManualPage._get_name_and_section(
             path
@@ -90,8 +125,57 @@ class ManualPage:
         self._last_modification_time = 0 # Sentinel 
         self._hashes = set()
         self._model = get_model()
+        self._clean = False # Whether sections are preprocessed
+
+        self.record_path(path, modification_time)
 
-        self.record_path(path)
+    @classmethod
+    def from_cache(
+            cls,
+            data : dict,
+            path : str,
+            modification_time : float
+        ) -> "ManualPage":
+        """
+        A manual page object restored from data given by get_save_info,
+        instead of from reading a file. The page at path, last modified
+        at modification_time, is recorded as the one the data came from.
+        """
+        page = cls.__new__(cls)
+        page._paths = [path]
+        page._path_times = [modification_time]
+        page._title = data["title"]
+        page._section_number = data["section"]
+        page._sections = dict(data["sections"])
+        page._last_modification_time = data["modification"]
+        page._hashes = set() # Not saved, so don't merge read pages into this
+        page._model = get_model()
+        page._clean = True
+        return page
+
+    def copy_for(
+            self,
+            path : str,
+            modification_time : Union[float, None] = None
+        ) -> "ManualPage":
+        """
+        A manual page object for path, another name of the file this page
+        was read from. Whatever was read is shared instead of being read
+        again, but the title and section come from path.
+        """
+        page = ManualPage.__new__(ManualPage)
+        page._paths = [ ]
+        page._path_times = [ ]
+        page._title, page._section_number = ManualPage._get_name_and_section(
+            path
+        )
+        page._sections = dict(self._sections)
+        page._last_modification_time = 0 # Sentinel 
+        page._hashes = set(self._hashes)
+        page._model = self._model
+        page._clean = self._clean
+        page.record_alias(path, modification_time)
+        return page
 
     def __str__(self) -> str:
         """str(self) - Pretty printed string version"""
@@ -101,106 +185,88 @@ Section:{self._section_number}
 Modification:{self._last_modification_time}
 """
 
-    def _extract_info(self, path : str):
-        """Read info from file to this object."""
-        # Information that requires reading the file
+    @staticmethod
+    def render(path : str) -> bytes:
+        """
+        Reads the manual page at path, decompressing if needed, and
+        returns the ascii text groff renders from it. Does not touch any
+        object state, so it may be run in a worker process.
+        """
         with open(path, "rb") as file_obj:
             #
             # Determine File Type
             # 
-            # Check for magic characters
-            compress_t = self._TYPE_LOOKUP.setdefault(
-                file_obj.read(2),
+            # Check for magic characters, peeking leaves them to be read
+            compress_t = ManualPage._TYPE_LOOKUP.get(
+                file_obj.peek(2)[:2],
                 _CompressT.NONE
             )
 
-            # Go back to start
-            if file_obj.seekable():
-                file_obj.seek(0)
-            else:
-                file_obj.close()
-                file_obj = open(path, "rb")
-
             # 
             # Extract information
             #
-            # Get appropriate file object
-            if compress_t == _CompressT.GZIP:
-                zipped_file = gzip.GzipFile(fileobj=file_obj)
-            elif compress_t == _CompressT.BZIP2:
-                zipped_file = bz2.BZ2File(file_obj)
+            # Get the page's text, or the file itself if not compressed,
+            # and the start of the text
+            if compress_t == _CompressT.NONE:
+                source = file_obj
+                head = file_obj.peek(_HEAD_SIZE)[:_HEAD_SIZE]
             else:
-                zipped_file = file_obj
-
-            # Parse through file
-            self._parse(zipped_file, path);
-
-            # Close wrapper file object as appropriate
-            if compress_t == _CompressT.GZIP or compress_t == _CompressT.BZIP2:
-                zipped_file.close()
+                if compress_t == _CompressT.GZIP:
+                    source = _gunzip(file_obj.read())
+                else:
+                    source = bz2.decompress(file_obj.read())
+                head = source[:_HEAD_SIZE]
+
+            if _is_prerendered(head):
+                # Cat pages are already what groff would output
+                groff_output = (
+                    file_obj.read() if compress_t == _CompressT.NONE
+                    else source
+                )
+            else:
+                # Let groff create the plaintext
+                groff_output = _run_groff(source, os.path.dirname(path))
 
-    def _parse(self, zipped_file, path : str):
-        """Set local variables to store relevant information on page."""
-        # Let groff create the plaintext
-        try:
-            groff_result = subprocess.run(
-                ["groff", "-Tascii", "-man"], # Internationalization ?
-                input=zipped_file.read(),
-                capture_output=True,
-                cwd=os.path.dirname(path)
-            )
-        except FileNotFoundError:
-            raise DependencyNotFoundError("Could not find 'groff' to run.")
+        return groff_output
 
+    def _parse(self, groff_output : bytes):
+        """
+        Set local variables to store relevant information on page, given
+        the groff output for it.
+        """
         # First, check if we need to record
-        hasher = sha1()
-        this_hash = hasher.update(groff_result.stdout)
+        this_hash = _fingerprint(groff_output)
         if this_hash in self._hashes:
             # Very likely already seen, don't continue
             return
         # If here, definitely haven't seen yet.
         self._hashes.add(this_hash)
 
-        # Get decoded full text as list of lines
-        # Get rid of bold/italic weirdness
-        full_text = _degrotty(
-            groff_result.stdout.decode("ascii", "ignore").splitlines()
-        )
-
-        if len(full_text) == 0:
-            # Likely caused by another file being sourced into this one
-            # Still need to extract, so don't change that
-            return
-
-        # Phase 1: Go past title
-        line_idx = 0
-        while full_text[line_idx].strip() == '':
-            line_idx += 1
-
-        #
-        # Phase 2: Read through entire file looking for sections. Keep
-        # the ones considered significant
-        #
-        current_section = None # Write into this section
-        for line in full_text[1:]:
-            # Skip empty lines
-            if line == '' or line.isspace():
+        # Get rid of bold/italic weirdness, leaving the text as bytes so
+        # that only the sections kept are ever decoded
+        full_text = _degrotty(groff_output)
+
+        # First line is the title, the rest is read through looking for
+        # sections. Keep the ones considered significant
+        body = full_text.partition(b"\n")[2]
+        titles = list(_SECTION_TITLE_RE.finditer(body))
+        for title, next_title in zip(titles, titles[1:] + [None]):
+            section_name = title.group().strip().decode("ascii")
+            if not _is_desireable_section(section_name):
                 continue
 
-            if _is_section_title(line):
-                current_section = None # Not in old section any more
-                isolated_section_name = line.strip()
-                if _is_desireable_section(isolated_section_name):
-                    current_section = isolated_section_name
-                    if isolated_section_name in self._sections:
-                        self._sections[isolated_section_name] += " "
-                    else:
-                        self._sections[isolated_section_name] = ""
-                    continue # Don't write name itself
-
-            # Write lines to relevant section
-            if current_section is not None:
-                self._sections[current_section] += line.strip() + " "
+            # Write non-empty lines up to the next title to the section,
+            # each stripped and followed by a space
+            end = len(body) if next_title is None else next_title.start()
+            text = body[title.end():end].strip()
+            if text != b'':
+                text = _LINE_BREAK_RE.sub(b" ", text) + b" "
+            text = text.decode("ascii", "ignore")
+            if section_name in self._sections:
+                self._sections[section_name] += " " + text
+            else:
+                self._sections[section_name] = text
+            self._clean = False
 
     def _clean_data(self):
         """
@@ -209,22 +275,67 @@ Modification:{self._last_modification_time}
         """
         if len(self._sections) == 0:
             return False
+        if self._clean:
+            return True
+        self._clean = True
         for section in self._sections:
             self._sections[section] = self._model.preprocess(
                 self._sections[section]
             )
         return True
 
-    def record_path(self, path : str):
-        """Updates object record of paths seen."""
+    def record_alias(
+            self,
+            path : str,
+            modification_time : Union[float, None] = None
+        ):
+        """
+        Updates object record of paths seen, for a path to a file that
+        was already read into this object. The file's modification time
+        is looked up unless given.
+        """
         # Record that this was called
         self._paths.append(path)
         # See if need to update time
-        self_last_modification_time = max(
-            os.path.getmtime(path), self._last_modification_time
+        if modification_time is None:
+            modification_time = os.path.getmtime(path)
+        self._path_times.append(modification_time)
+        self._last_modification_time = max(
+            modification_time, self._last_modification_time
         )
+
+    def record_path(
+            self,
+            path : str,
+            modification_time : Union[float, None] = None
+        ):
+        """Updates object record of paths seen, and reads the file at path."""
+        self.record_alias(path, modification_time)
         # Extract any new information
-        self._extract_info(path)
+        self._parse(ManualPage.render(path))
+
+    def merge(self, other : "ManualPage"):
+        """
+        Takes in the paths of other, a page of the same name read from a
+        different file, along with any of its information not already
+        seen.
+        """
+        self._paths.extend(other._paths)
+        self._path_times.extend(other._path_times)
+        self._last_modification_time = max(
+            other._last_modification_time, self._last_modification_time
+        )
+        if other._hashes <= self._hashes:
+            # Very likely already seen, don't continue
+            return
+        self._hashes |= other._hashes
+
+        for section_name, text in other._sections.items():
+            if section_name in self._sections:
+                self._sections[section_name] += " " + text
+            else:
+                self._sections[section_name] = text
+            self._clean = self._clean and other._clean
 
     def get_save_info(self) -> Tuple[str, dict]:
         """Returns the title and dictionary of things worth caching."""
@@ -242,63 +353,134 @@ Modification:{self._last_modification_time}
             "section" : self._section_number,
             "paths" : self._paths,
             "modification" : self._last_modification_time,
+            "modification_times" : self._path_times,
             "sections" : self._sections
         }
 
 
-def _is_section_title(line : str) -> bool:
+def _fingerprint(data : bytes) -> int:
+    """
+    Returns a 64 bit hash of data, used to tell whether the same output
+    was already read. It only has to be unlikely to collide, not secure.
+    """
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(
+        hashlib.blake2b(data, digest_size=8).digest(), "little"
+    )
+
+
+def _gunzip(data : bytes) -> bytes:
+    """
+    Decompresses the whole of the gzip data in one call, with libdeflate
+    if the deflate module is installed.
+    """
+    if deflate is not None:
+        return deflate.gzip_decompress(data)
+    return gzip.decompress(data)
+
+
+def _is_prerendered(head : bytes) -> bool:
+    """
+    Returns True if head, the start of a page's text, looks to be groff
+    output already rather than roff source.
+    """
+    return _ROFF_REQUEST_RE.search(head) is None
+
+
+@functools.lru_cache(maxsize=None)
+def _render_command() -> Tuple[str, ...]:
+    """
+    Returns the command line used to render pages. mandoc is used when
+    installed, since it is built for manual pages and starts much faster
+    than groff, which is used otherwise. Both print the same overstruck
+    ascii text.
+    """
+    if shutil.which("mandoc") is not None:
+        return ("mandoc", "-Tascii")
+    return ("groff", "-Tascii", "-man") # Internationalization ?
+
+
+def _run_groff(source : Union[io.BufferedReader, bytes], cwd : str) -> bytes:
     """
-    Given an isolated line as ouput by groff, returns True if it is a 
-    section title of a manpage.
+    Returns groff's plaintext rendering of source, running from directory
+    cwd. Source is either the page's text or a plain file, whose
+    descriptor groff then reads on its own. mandoc stands in for groff if
+    found, see _render_command.
     """
-    return (
-        line.isupper() # Uppercase
-        and (not line[0].isspace()) # First part of line
-        and all([tok.isalpha() for tok in line.split()]) # Alphabet only
+    passthrough = isinstance(source, io.BufferedReader)
+    if passthrough:
+        # A buffered read may have moved the descriptor groff inherits
+        os.lseek(source.fileno(), source.tell(), os.SEEK_SET)
+
+    try:
+        proc = subprocess.Popen(
+            _render_command(),
+            stdin=source if passthrough else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=cwd
         )
+    except FileNotFoundError:
+        raise DependencyNotFoundError(
+            f"Could not find '{_render_command()[0]}' to run."
+        )
+
+    # Writes the text while reading, so neither pipe can fill and stall
+    output, _ = proc.communicate(None if passthrough else source)
+    return output
 
 
-def _degrotty(full_text : List[str]) -> List[str]:
+def _degrotty(text : bytes) -> bytes:
     """
-    Given a list of lines as output by groff, replaces special sequences
-    for bold characters and italic characters with their single
-    character replacements in the output list of strings.
+    Given text as output by groff, replaces special sequences for bold
+    characters and italic characters with their single character
+    replacements.
     """
-    undo_bold = lambda line : re.sub("(.)\x08\\1", r"\1", line)
-    undo_italics = lambda line : re.sub("_\x08(.)", r"\1", line)
-    return [undo_italics(undo_bold(line)) for line in full_text]
+    return _ITALIC_RE.sub(rb"\1", _BOLD_RE.sub(rb"\1", text))
 
 
 _GOOD_SECTIONS = None
 _SECTION_FILE = None
+_DEFAULT_SECTION_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.path.pardir,
+    "config",
+    ".sections"
+)
 
 
-def _is_desireable_section(section_name : str) -> bool:
-    """Returns True if section_name is listed in _SECTION_FILE."""
+def _load_good_sections() -> frozenset:
+    """
+    Returns the section names listed in _SECTION_FILE, reading the file
+    only the first time it's needed.
+    """
     global _GOOD_SECTIONS, _SECTION_FILE
 
     # Case need to generate
     if _GOOD_SECTIONS is None:
-        _GOOD_SECTIONS = set()
-
         # Determine where the file is
         if _SECTION_FILE is None:
-            _SECTION_FILE = os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                os.path.pardir,
-                "config",
-                ".sections"
-            )
+            _SECTION_FILE = _DEFAULT_SECTION_FILE
 
         try:
             with open(_SECTION_FILE, "r") as config_file:
-                for line in config_file:
-                    _GOOD_SECTIONS.add(line.upper().strip())
+                _GOOD_SECTIONS = frozenset(
+                    line.upper().strip() for line in config_file
+                )
         except FileNotFoundError:
             raise FileNotFoundError(f"{_SECTION_FILE} file is missing!")
 
-    # Then check inside
-    return section_name in _GOOD_SECTIONS
+    return _GOOD_SECTIONS
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_desireable_section(section_name : str) -> bool:
+    """
+    Returns True if section_name is listed in _SECTION_FILE. Answers are
+    remembered until set_section_file is called.
+    """
+    return section_name in _load_good_sections()
 
 
 def set_section_file(new_section_file_name : Union[str, None]):
@@ -315,6 +497,15 @@ def set_section_file(new_section_file_name : Union[str, None]):
     # Reset variables
     _GOOD_SECTIONS = None
     _SECTION_FILE = new_section_file_name
+    _is_desireable_section.cache_clear()
+
+
+def get_section_file() -> Union[str, None]:
+    """
+    Retrieves the name of the file sections are read from, or None if
+    the default will be used.
+    """
+    return _SECTION_FILE
 
 
 _MODEL = None